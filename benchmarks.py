@@ -0,0 +1,203 @@
+""" Benchmarks of the hill shading functions.
+
+    Call the script with the names of the benchmarks to run as arguments. Without arguments all
+    benchmarks are run. The --size=N argument sets the size of the test data (default 1000).
+
+    Benchmarks:
+        products: hill_shade_products versus calling hill_shade for each product.
+        batch: hill_shade_batch versus calling hill_shade for each 64x64 chip.
+        import: import time of the shading modules. Fails if they import matplotlib, or if
+            importing takes longer than MAX_IMPORT_SECONDS.
+        tiling: duration and peak memory of shading in tiles of several sizes and halos. Fails
+            if the tiled result differs from shading the whole array at once.
+"""
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import matplotlib as mpl
+
+from plotting import make_test_data
+from hillshade import hill_shade, hill_shade_products, hill_shade_batch
+from hillshade import no_blending, rgb_blending, pegtop_blending, INTENSITY_CMAP, DEF_CMAP
+from hillshade import make_norm
+from intensity import GRADIENT_HALO
+from tiling import LazyHillShade
+
+DEF_SIZE = 1000
+DEF_REPEAT = 3
+
+MAX_IMPORT_SECONDS = 1.0
+NUMPY_ONLY_MODULES = ['intensity', 'tiling', 'hillshade']
+
+TILING_SHAPES = ['circles', 'hills']
+TILING_OPERATORS = ['central', 'horn']
+TILING_CHUNKS = [64, 256, 1024]
+TILING_HALOS = [0, GRADIENT_HALO, GRADIENT_HALO + 1]
+
+
+def best_time(function, repeat=DEF_REPEAT):
+    """ Calls function repeat times and returns the fastest duration in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def bench_products(size):
+    """ Compares hill_shade_products with calling hill_shade for the products one by one.
+    """
+    data = make_test_data('hills', noise_factor=0.05, size=size)
+    products = {'intensity': (INTENSITY_CMAP, mpl.colors.Normalize(0.0, 1.0), no_blending),
+                'rgb': (DEF_CMAP, mpl.colors.Normalize(), rgb_blending),
+                'pegtop': (DEF_CMAP, mpl.colors.Normalize(), pegtop_blending)}
+
+    def separate_calls():
+        for cmap, norm, blend_function in products.values():
+            hill_shade(data, terrain=data * 10, cmap=cmap, norm=norm,
+                       blend_function=blend_function)
+
+    def single_pass():
+        hill_shade_products(data, products, terrain=data * 10)
+
+    separate_duration = best_time(separate_calls)
+    single_duration = best_time(single_pass)
+    print("products ({} products, {}x{}):".format(len(products), size, size))
+    print("  separate hill_shade calls: {:8.3f} s".format(separate_duration))
+    print("  hill_shade_products:       {:8.3f} s ({:.2f}x faster)"
+          .format(single_duration, separate_duration / single_duration))
+
+
+def bench_batch(size, chip_size=64):
+    """ Compares hill_shade_batch with calling hill_shade for each chip.
+        The test data is cut into chips of chip_size by chip_size pixels.
+    """
+    data = make_test_data('hills', noise_factor=0.05, size=size)
+    n_chips = size // chip_size
+    chips = data[:n_chips * chip_size, :n_chips * chip_size]
+    chips = chips.reshape(n_chips, chip_size, n_chips, chip_size).swapaxes(1, 2)
+    chips = np.ascontiguousarray(chips.reshape(-1, chip_size, chip_size))
+    vmins = np.min(chips, axis=(1, 2))
+
+    def loop():
+        for chip, vmin in zip(chips, vmins):
+            hill_shade(chip, vmin=vmin, vmax=vmin + 1.0)
+
+    def batch():
+        hill_shade_batch(chips, vmin=vmins, vmax=vmins + 1.0)
+
+    loop_duration = best_time(loop)
+    batch_duration = best_time(batch)
+    print("batch ({} chips of {}x{}):".format(len(chips), chip_size, chip_size))
+    print("  hill_shade loop:  {:10.0f} chips/s".format(len(chips) / loop_duration))
+    print("  hill_shade_batch: {:10.0f} chips/s ({:.2f}x faster)"
+          .format(len(chips) / batch_duration, loop_duration / batch_duration))
+
+
+def bench_import(_size):
+    """ Imports the shading modules in a new Python process and checks that this is fast and
+        does not import matplotlib.
+    """
+    script = ("import sys, time; start = time.perf_counter(); import {}; "
+              "print(time.perf_counter() - start, 'matplotlib' in sys.modules)")
+    print("import:")
+    for module_name in NUMPY_ONLY_MODULES:
+        output = subprocess.check_output([sys.executable, '-c', script.format(module_name)])
+        duration, matplotlib_imported = output.decode('ascii').split()
+        duration = float(duration)
+        print("  {:12s} {:8.3f} s".format(module_name, duration))
+        assert matplotlib_imported == 'False', \
+            "importing {} should not import matplotlib".format(module_name)
+        assert duration < MAX_IMPORT_SECONDS, \
+            "importing {} took {:.3f} s (max: {} s)".format(module_name, duration, 
+                                                           MAX_IMPORT_SECONDS)
+
+
+def measure(function):
+    """ Returns the result of function, its duration and the peak of the memory that it allocated.
+
+        The function is called twice: once to time it and once to trace its memory allocations
+        (numpy reports them to tracemalloc). Tracing slows down the many small allocations of
+        small tiles, so it would distort the timing.
+    """
+    start = time.perf_counter()
+    result = function()
+    duration = time.perf_counter() - start
+    del result
+
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, duration, peak_memory
+
+
+def bench_tiling(size):
+    """ Shades noisy test terrains whole and in tiles of several sizes and halos, and checks
+        that the tiled results are identical to the whole result if the halo is large enough.
+        A halo of 0 is included to show that naive tiling gives seams.
+    """
+    num_workers = os.cpu_count() or 1
+    print("tiling ({}x{}, {} threads):".format(size, size, num_workers))
+    print("  {:8s} {:8s} {:>6s} {:>5s} {:>9s} {:>9s}  {}".format(
+        'shape', 'gradient', 'tile', 'halo', 'time [s]', 'peak [MB]', 'result'))
+
+    for shape in TILING_SHAPES:
+        data = make_test_data(shape, noise_factor=0.05, size=size)
+        terrain = data * 5
+        norm = make_norm(vmin=data.min(), vmax=data.max())
+
+        for operator in TILING_OPERATORS:
+            whole, duration, peak_memory = measure(
+                lambda: hill_shade(data, terrain=terrain, norm=norm, gradient_operator=operator))
+            print("  {:8s} {:8s} {:>6s} {:>5s} {:9.3f} {:9.1f}".format(
+                shape, operator, 'whole', '', duration, peak_memory / 1e6))
+
+            for chunk in TILING_CHUNKS:
+                for halo in TILING_HALOS:
+                    lazy = LazyHillShade(hill_shade, data, terrain, norm=norm,
+                                         chunks=(chunk, chunk), halo=halo,
+                                         gradient_operator=operator)
+                    tiled, duration, peak_memory = measure(
+                        lambda: lazy.compute(num_workers=num_workers))
+
+                    n_seam_pixels = np.count_nonzero(np.any(tiled != whole, axis=-1))
+                    if n_seam_pixels == 0:
+                        verdict = 'identical'
+                    else:
+                        verdict = '{} pixels differ'.format(n_seam_pixels)
+                    print("  {:8s} {:8s} {:6d} {:5d} {:9.3f} {:9.1f}  {}".format(
+                        shape, operator, chunk, halo, duration, peak_memory / 1e6, verdict))
+
+                    if halo >= GRADIENT_HALO:
+                        assert n_seam_pixels == 0, \
+                            "tiled result differs from whole result: {}".format(verdict)
+
+
+BENCHMARKS = {'products': bench_products,
+              'batch': bench_batch,
+              'import': bench_import,
+              'tiling': bench_tiling}
+
+
+def main():
+    size = DEF_SIZE
+    names = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--size='):
+            size = int(arg[len('--size='):])
+        else:
+            names.append(arg)
+
+    for name in names or sorted(BENCHMARKS.keys()):
+        BENCHMARKS[name](size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Pepijn Kenter
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+""" Persistent on-disk cache of hill shading results.
+
+    Results are stored as NPY files of which the name is a hash of all the inputs of hill_shade.
+    A cache hit therefore only costs hashing the input and memory mapping the stored file.
+
+    See https://github.com/titusjan/hill_shading for updates.
+"""
+
+import copy
+import hashlib
+import numbers
+import os
+import tempfile
+
+import numpy as np
+
+from hillshade import hill_shade, no_blending, rgb_blending, get_cmap, make_norm
+from intensity import DEF_AZIMUTH, DEF_ELEVATION, DEF_AMBIENT_WEIGHT, DEF_LAMP_WEIGHT
+from intensity import DEF_GRADIENT_OPERATOR, enforce_list
+from tiling import is_chunked
+
+CACHE_VERSION = 2 # Increase when a change in the algorithm invalidates the stored results.
+
+DEF_MAX_BYTES = 2 * 1024 ** 3
+SCAN_INTERVAL = 64 # number of stores after which the cache directory is measured again
+EVICT_FRACTION = 0.9 # size, as fraction of max_bytes, to which the cache is reduced by evict
+NORM_PROBE_SIZE = 4097 # number of values on which the norm is evaluated for the hash
+
+
+def default_file_mode():
+    """ Returns the permissions that a new file gets with the current umask.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def _update_with_array(hasher, array):
+    """ Adds the dtype, shape and contents of the array to the hash.
+    """
+    array = np.ascontiguousarray(array)
+    hasher.update("{}{}".format(array.dtype.str, array.shape).encode('ascii'))
+    hasher.update(memoryview(array).cast('B'))
+
+
+def _update_with_cmap(hasher, cmap):
+    """ Adds the colors of the color map, including the bad, under and over colors, to the hash.
+        Two color maps are therefore only considered the same if they give the same colors.
+    """
+    samples = np.concatenate([np.linspace(0.0, 1.0, cmap.N), [-1.0, 2.0, np.nan]])
+    hasher.update("{}{}".format(cmap.name, cmap.N).encode('utf-8'))
+    _update_with_array(hasher, cmap(samples))
+
+
+def _update_with_norm(hasher, norm, vmin, vmax, data):
+    """ Adds the behaviour of the normalization function to the hash.
+
+        The norm is auto-scaled with the data, like hill_shade does, and evaluated on a fixed
+        probe around its (vmin, vmax) interval. Its numeric attributes (e.g. the gamma of a
+        PowerNorm or the boundaries of a BoundaryNorm) are added as well. Two norms are therefore
+        only considered the same if they normalize the same way, whatever their type.
+    """
+    if norm is None:
+        norm = make_norm(vmin=vmin, vmax=vmax)
+    else:
+        norm = copy.deepcopy(norm) # don't auto-scale the caller's norm (or notify its observers)
+
+    if not norm.scaled():
+        norm.autoscale_None(data)
+
+    hasher.update("{}.{}".format(type(norm).__module__, type(norm).__qualname__).encode('utf-8'))
+    for name, value in sorted(vars(norm).items()):
+        if isinstance(value, (numbers.Number, np.ndarray)):
+            hasher.update(name.encode('utf-8'))
+            _update_with_array(hasher, np.asarray(value, dtype=np.float64))
+
+    low, high = float(norm.vmin), float(norm.vmax)
+    margin = (high - low) / 4 if high > low else 1.0
+    samples = np.concatenate([np.linspace(low - margin, high + margin, NORM_PROBE_SIZE), [np.nan]])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized = np.ma.filled(np.ma.asarray(norm(samples), dtype=np.float64), np.nan)
+    _update_with_array(hasher, normalized)
+
+
+def stable_name(function):
+    """ Returns the 'module.qualified_name' of a function, or None if the name does not identify
+        the function. That's the case for lambdas, nested functions (closures) and objects
+        without a name, such as functools.partial objects.
+    """
+    module = getattr(function, '__module__', None)
+    qualified_name = getattr(function, '__qualname__', None)
+    if module is None or qualified_name is None:
+        return None
+    if '<lambda>' in qualified_name or '<locals>' in qualified_name:
+        return None
+    return "{}.{}".format(module, qualified_name)
+
+
+class ShadeCache(object):
+    """ Content-addressed disk cache around the hill_shade function.
+
+        Call the hill_shade method of the cache instead of the hill_shade function. It has the
+        same parameters but looks up the result in the cache directory first. If the total size
+        of the directory exceeds max_bytes, the least recently used results are removed until it
+        is no larger than EVICT_FRACTION * max_bytes.
+
+        To check the size, the directory is only listed when the results stored by this object
+        push the size past max_bytes, or every SCAN_INTERVAL stores to include the results of
+        other processes. Storing N results therefore doesn't cost N directory listings.
+
+        Results are written to a temporary file first, which is then renamed. Several processes
+        can therefore share the same cache directory.
+
+        The blend function is identified by its name. Results of blend functions without a stable
+        name (see stable_name) are calculated but not cached.
+    """
+    def __init__(self, directory, max_bytes=DEF_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached = 0
+        self._n_bytes = None # size of the directory at the last listing plus the stored results
+        self._n_stores_since_scan = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __repr__(self):
+        return "<ShadeCache directory={!r}, max_bytes={}>".format(self.directory, self.max_bytes)
+
+    def key(self, data, terrain=None,
+            azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION,
+            ambient_weight=DEF_AMBIENT_WEIGHT, lamp_weight=DEF_LAMP_WEIGHT,
+            cmap=None, vmin=None, vmax=None, norm=None,
+            blend_function=rgb_blending, gradient_operator=DEF_GRADIENT_OPERATOR,
+            intensity_range=None):
+        """ Returns the hash of the hill_shade parameters as hexadecimal string.
+            Returns None if the blend function has no stable name, so the result can't be cached.
+        """
+        blend_name = stable_name(blend_function)
+        if blend_name is None:
+            return None
+
+        hasher = hashlib.sha256()
+        hasher.update("hill_shade cache v{}".format(CACHE_VERSION).encode('ascii'))
+
+        _update_with_array(hasher, data)
+        if terrain is None or terrain is data:
+            hasher.update(b"terrain is data")
+        else:
+            _update_with_array(hasher, terrain)
+
+        for values in (azimuth, elevation, ambient_weight, lamp_weight):
+            _update_with_array(hasher, np.array(enforce_list(values), dtype=np.float64))
+
+        if blend_function is no_blending:
+            hasher.update(b"no colors") # the cmap and norm don't change the intensities
+        else:
+            _update_with_cmap(hasher, get_cmap(cmap))
+            _update_with_norm(hasher, norm, vmin, vmax, data)
+        hasher.update(blend_name.encode('utf-8'))
+        hasher.update(gradient_operator.encode('utf-8'))
+        hasher.update("{!r}".format(intensity_range).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def file_name(self, key):
+        """ Returns the file name where the result with this key is stored.
+        """
+        return os.path.join(self.directory, key + '.npy')
+
+    def hill_shade(self, data, terrain=None,
+                   azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION,
+                   ambient_weight=DEF_AMBIENT_WEIGHT, lamp_weight=DEF_LAMP_WEIGHT,
+                   cmap=None, vmin=None, vmax=None, norm=None,
+                   blend_function=rgb_blending, gradient_operator=DEF_GRADIENT_OPERATOR,
+                   intensity_range=None):
+        """ Returns the hill_shade result from the cache, or calculates and stores it.
+
+            A cached result is returned as a read-only memory map. See hillshade.hill_shade for
+            the parameters. Chunked arrays are not supported, their results are usually too large
+            to cache.
+        """
+        assert not is_chunked(data) and not is_chunked(terrain), \
+            "chunked arrays are not supported by the cache"
+
+        key = self.key(data, terrain=terrain,
+                       azimuth=azimuth, elevation=elevation,
+                       ambient_weight=ambient_weight, lamp_weight=lamp_weight,
+                       cmap=cmap, vmin=vmin, vmax=vmax, norm=norm,
+                       blend_function=blend_function, gradient_operator=gradient_operator,
+                       intensity_range=intensity_range)
+        if key is None:
+            self.uncached += 1
+            return hill_shade(data, terrain=terrain,
+                              azimuth=azimuth, elevation=elevation,
+                              ambient_weight=ambient_weight, lamp_weight=lamp_weight,
+                              cmap=cmap, vmin=vmin, vmax=vmax, norm=norm,
+                              blend_function=blend_function, gradient_operator=gradient_operator,
+                              intensity_range=intensity_range)
+
+        file_name = self.file_name(key)
+        try:
+            result = np.load(file_name, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            pass # not in the cache, or removed by another process in the mean time
+        else:
+            self.hits += 1
+            try:
+                os.utime(file_name, None) # mark as recently used
+            except OSError:
+                pass # removed by another process, the memory map is still valid
+            if norm is not None and blend_function is not no_blending and not norm.scaled():
+                norm.autoscale_None(data) # same side effect as hill_shade has
+            return result
+
+        self.misses += 1
+        result = hill_shade(data, terrain=terrain,
+                            azimuth=azimuth, elevation=elevation,
+                            ambient_weight=ambient_weight, lamp_weight=lamp_weight,
+                            cmap=cmap, vmin=vmin, vmax=vmax, norm=norm,
+                            blend_function=blend_function, gradient_operator=gradient_operator,
+                            intensity_range=intensity_range)
+        self.store(key, result)
+        return result
+
+    def store(self, key, result):
+        """ Writes the result to the cache and evicts old results if the cache is too large.
+        """
+        file_descriptor, temp_file_name = tempfile.mkstemp(
+            dir=self.directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                np.save(file, result)
+                n_bytes = file.tell()
+            os.chmod(temp_file_name, default_file_mode()) # mkstemp gives owner-only permissions
+            os.replace(temp_file_name, self.file_name(key))
+        except BaseException:
+            os.remove(temp_file_name)
+            raise
+
+        if self._n_bytes is not None:
+            self._n_bytes += n_bytes
+            self._n_stores_since_scan += 1
+        if (self._n_bytes is None or self._n_bytes > self.max_bytes or
+                self._n_stores_since_scan >= SCAN_INTERVAL):
+            self.evict()
+
+    def _entries(self):
+        """ Returns a list of (modification time, size, file name) tuples of the cached results.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            file_name = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                continue # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+        return entries
+
+    def evict(self):
+        """ Removes the least recently used results if the cache is larger than max_bytes.
+            Results are removed until the cache is no larger than EVICT_FRACTION * max_bytes,
+            so that the next stores don't need to evict again.
+        """
+        entries = sorted(self._entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        target_bytes = self.max_bytes if total_bytes <= self.max_bytes else \
+            EVICT_FRACTION * self.max_bytes
+        for _, size, file_name in entries:
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass # removed by another process
+            else:
+                self.evictions += 1
+            total_bytes -= size
+
+        self._n_bytes = total_bytes
+        self._n_stores_since_scan = 0
+
+    def clear(self):
+        """ Removes all results from the cache.
+        """
+        self._n_bytes = None
+        for _, _, file_name in self._entries():
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+
+    def statistics(self):
+        """ Returns a dictionary with the hit, miss and uncached counts of this cache object, and
+            the number of files and bytes in the cache directory.
+        """
+        entries = self._entries()
+        n_lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / n_lookups if n_lookups else 0.0,
+                'evictions': self.evictions,
+                'uncached': self.uncached,
+                'n_files': len(entries),
+                'n_bytes': sum(size for _, size, _ in entries)}
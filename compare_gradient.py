@@ -0,0 +1,39 @@
+""" Compares the gradient operators on noisy test data.
+
+    The central differences of np.gradient amplify the noise. The Horn (Sobel) and Scharr
+    operators average the differences of the neighbouring rows or columns, which smooths the noise
+    without a separate filter pass. Call the script with a noise factor as argument to change the
+    amount of noise (default 0.05).
+"""
+import sys
+import matplotlib as mpl
+
+mpl.interactive(False)
+import matplotlib.pyplot as plt
+
+from plotting import make_test_data, draw
+from hillshade import hill_shade, no_blending, INTENSITY_CMAP
+
+
+def main():
+    fig, ax = plt.subplots(2, 2, figsize=(10, 10))
+    fig.tight_layout()
+
+    noise_factor = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+    terrain = 5 * make_test_data('circles', noise_factor=noise_factor)
+
+    # Don't auto scale the intensities, it gives the wrong impression
+    norm = mpl.colors.Normalize(vmin=0.0, vmax=1.0)
+
+    for idx, operator in enumerate(['central', 'zevenbergen_thorne', 'horn', 'scharr']):
+        row = idx // 2
+        col = idx % 2
+        draw(ax[row, col], cmap=INTENSITY_CMAP, norm=norm,
+             title='gradient_operator = {!r}'.format(operator),
+             image_data = hill_shade(terrain, blend_function=no_blending,
+                                     cmap=INTENSITY_CMAP, norm=norm,
+                                     gradient_operator=operator))
+    plt.show()
+
+if __name__ == "__main__":
+    main()
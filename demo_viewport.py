@@ -0,0 +1,31 @@
+""" Shows a large terrain that is only shaded for the visible part, at screen resolution.
+
+    Use the zoom and pan tools of the figure window. The image is reshaded for the new view, at
+    full resolution once there are fewer data pixels than screen pixels.
+"""
+import numpy as np
+import matplotlib as mpl
+
+mpl.interactive(False)
+import matplotlib.pyplot as plt
+
+from plotting import make_test_data, ViewportHillShade
+
+
+def main():
+    fig, axes = plt.subplots(1, 1, figsize=(8, 8))
+
+    # Generate a terrain of 4000 by 4000 pixels
+    data = make_test_data('hills', noise_factor=0.05, size=4000) / 2 + 2
+    print("data range: {} {}".format(np.min(data), np.max(data)))
+
+    # Keep a reference to the viewport, the axes only keep a weak reference to its callbacks.
+    viewport = ViewportHillShade(axes, data, terrain=data * 50, cmap='gist_earth',
+                                 vmin=-5, vmax=5, gradient_operator='horn')
+    axes.set_title('Zoom in to see the details')
+
+    plt.show()
+    return viewport
+
+if __name__ == "__main__":
+    main()
@@ -29,23 +29,83 @@
 from __future__ import print_function
 from __future__ import division
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
 
-from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
 from intensity import weighted_intensity
 from intensity import DEF_AZIMUTH, DEF_ELEVATION, DEF_AMBIENT_WEIGHT, DEF_LAMP_WEIGHT
+from intensity import DEF_GRADIENT_OPERATOR
+from tiling import is_chunked, LazyHillShade
+
+# Matplotlib is only imported when data is colored, so that the shading itself only needs numpy.
+# The INTENSITY_CMAP and DEF_CMAP color maps are therefore created on first use (see __getattr__).
 
 # For choosing a good color map see:
 #    http://matplotlib.org/users/colormaps.html 
 
-INTENSITY_CMAP = plt.cm.get_cmap('gray')
-INTENSITY_CMAP.set_bad('red')
-INTENSITY_CMAP.set_over('blue')    # to check that no intensity is above 1
-INTENSITY_CMAP.set_under('yellow') # to check that no intensity is below 0
+DEF_CMAP_NAME = 'gist_earth'
+
+DEF_TILE_ROWS = 256 # number of rows that hill_shade_products colors and blends in one go
+DEF_BATCH_PIXELS = 32768 # number of pixels that hill_shade_batch shades in one go
+
+LAZY_ATTRIBUTES = ('INTENSITY_CMAP', 'DEF_CMAP') # created by __getattr__
 
-DEF_CMAP = plt.cm.get_cmap('gist_earth')
+# Needed for 'from hillshade import *' to include the lazy attributes. It imports matplotlib.
+__all__ = ['INTENSITY_CMAP', 'DEF_CMAP', 'DEF_CMAP_NAME', 'DEF_TILE_ROWS', 'DEF_BATCH_PIXELS',
+           'DEF_AZIMUTH', 'DEF_ELEVATION', 'DEF_AMBIENT_WEIGHT', 'DEF_LAMP_WEIGHT', 
+           'DEF_GRADIENT_OPERATOR', 'weighted_intensity', 
+           'get_cmap', 'make_norm', 'is_non_finite_mask', 'replace_nans', 'normalize', 
+           'color_data', 'no_blending', 'rgb_blending', 'hsv_blending', 'pegtop_blending', 
+           'hill_shade', 'hill_shade_products', 'color_batch', 'hill_shade_batch']
+    
+    
+def __dir__():
+    """ Includes the lazy attributes in dir(hillshade), e.g. for code completion.
+    """
+    return sorted(set(globals()) | set(LAZY_ATTRIBUTES))
+
+
+def __getattr__(name):
+    """ Creates the INTENSITY_CMAP and DEF_CMAP module attributes on first use.
+    """
+    if name == 'INTENSITY_CMAP':
+        cmap = get_cmap('gray')
+        cmap.set_bad('red')
+        cmap.set_over('blue')    # to check that no intensity is above 1
+        cmap.set_under('yellow') # to check that no intensity is below 0
+    elif name == 'DEF_CMAP':
+        cmap = get_cmap(DEF_CMAP_NAME)
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    
+    globals()[name] = cmap
+    return cmap
+
+
+def get_cmap(cmap=None):
+    """ Returns a copy of the matplotlib color map if cmap is a name, or DEF_CMAP if it is None.
+        Other objects (e.g. color maps) are returned unaltered.
+    """
+    if cmap is None:
+        if 'DEF_CMAP' not in globals():
+            __getattr__('DEF_CMAP')
+        return globals()['DEF_CMAP']
+    
+    if not isinstance(cmap, str):
+        return cmap
+    
+    import matplotlib as mpl
+    try:
+        return mpl.colormaps[cmap] # returns a copy
+    except AttributeError:
+        return mpl.cm.get_cmap(cmap) # matplotlib < 3.5
+    
+    
+def make_norm(vmin=None, vmax=None):
+    """ Returns a mpl.colors.Normalize object for the (vmin, vmax) interval.
+        If vmin and vmax are None, it is auto-scaled on first use.
+    """
+    from matplotlib.colors import Normalize
+    return Normalize(vmin=vmin, vmax=vmax)
     
     
 def is_non_finite_mask(array):
@@ -70,7 +130,7 @@ def normalize(values, vmin=None, vmax=None, norm=None):
         If norm is None and vmin and vmax are None, the values are autoscaled.
     """
     if norm is None:
-        norm = mpl.colors.Normalize(vmin=vmin, vmax=vmax)
+        norm = make_norm(vmin=vmin, vmax=vmax)
         
     return norm(values) 
     
@@ -79,14 +139,14 @@ def color_data(data, cmap, vmin=None, vmax=None, norm=None):
     """ Auxiliary function that colors the data.
     """
     norm_data = normalize(data, vmin=vmin, vmax=vmax, norm=norm)
-    rgba = cmap(norm_data)
+    rgba = get_cmap(cmap)(norm_data)
     return rgba
 
 
 def no_blending(rgba, norm_intensities):
     """ Just returns the intensities. Use in hill_shade to just view the calculated intensities
     """
-    assert norm_intensities.ndim == 2, "norm_intensities must be 2 dimensional"
+    assert norm_intensities.ndim >= 2, "norm_intensities must be at least 2 dimensional"
     return norm_intensities
 
 
@@ -97,14 +157,15 @@ def rgb_blending(rgba, norm_intensities):
         :param norm_intensities: normalized intensities
         
         Returns 3D array that can be plotted with matplotlib.imshow(). The last dimension is RGB.
+        The arrays may have extra leading dimensions, e.g. the first dimension of a batch.
     """
-    assert rgba.ndim == 3, "rgb must be 3 dimensional"
-    assert norm_intensities.ndim == 2, "norm_intensities must be 2 dimensional"
+    assert norm_intensities.ndim >= 2, "norm_intensities must be at least 2 dimensional"
+    assert rgba.ndim == norm_intensities.ndim + 1, "rgb must have one dimension more"
     
     # Add artificial dimension of length 1 at the end of norm_intensities so that it can be
     # multiplied with the rgb array using numpy broad casting
-    expanded_intensities = np.expand_dims(norm_intensities, axis=2) 
-    rgb = rgba[:, :, :3]
+    expanded_intensities = np.expand_dims(norm_intensities, axis=-1) 
+    rgb = rgba[..., :3]
     
     return rgb * expanded_intensities
         
@@ -121,9 +182,11 @@ def hsv_blending(rgba, norm_intensities):
         
         Returns 3D array that can be plotted with matplotlib.imshow(). The last dimension is RGB.
     """
-    rgb = rgba[:, :, :3]
+    from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
+    
+    rgb = rgba[..., :3]
     hsv = rgb_to_hsv(rgb)
-    hsv[:, :, 2] = norm_intensities
+    hsv[..., 2] = norm_intensities
     return hsv_to_rgb(hsv)
     
     
@@ -142,7 +205,7 @@ def pegtop_blending(rgba, norm_intensities):
         Returns 3D array that can be plotted with matplotlib.imshow(). The last dimension is RGB.
     """
     # get rgb of normalized data based on cmap
-    rgb = rgba[:, :, :3]
+    rgb = rgba[..., :3]
     
     # form an rgb eqvivalent of intensity
     d = norm_intensities.repeat(3).reshape(rgb.shape)
@@ -154,8 +217,9 @@ def pegtop_blending(rgba, norm_intensities):
 def hill_shade(data, terrain=None, 
                azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION, 
                ambient_weight=DEF_AMBIENT_WEIGHT, lamp_weight=DEF_LAMP_WEIGHT, 
-               cmap=DEF_CMAP, vmin=None, vmax=None, norm=None, 
-               blend_function=rgb_blending):
+               cmap=None, vmin=None, vmax=None, norm=None, 
+               blend_function=rgb_blending, gradient_operator=DEF_GRADIENT_OPERATOR, 
+               intensity_range=None):
     """ Calculates a shaded relief given a 2D array of surface heights. 
     
         You can specify data properties and terrain height in separate parameters. The data array
@@ -176,7 +240,13 @@ def hill_shade(data, terrain=None,
         The blend_function is the function that merges the color and shade components into the
         final result. It was found that rbg_blending (the default) gives the best results. If set
         to no_blending, only the intensities of the shade component are returned. This is useful
-        for debugging.
+        for debugging. The data is then not colored, so the cmap and norm are not used and an 
+        unscaled norm is not auto-scaled.
+        
+        The data and terrain can also be chunked arrays (e.g. zarr or dask arrays, or a 
+        tiling.ChunkedArray that wraps a memory mapped NPY file). In that case a LazyHillShade is
+        returned, which shades the array chunk by chunk when it is materialized with its compute()
+        or to_npy() methods, or with np.asarray(). See the tiling module for details.
     
         :param data: 2D array with terrain properties
         :param terrain: 2D array with terrain heights
@@ -184,25 +254,245 @@ def hill_shade(data, terrain=None,
         :param elevation: elevation angle [degrees] of the lamp direction(s). Can be scalar or list.
         :param ambient_weight: the relative strength of the ambient illumination (default = 1)
         :param lamp_weight: the relative strength of the lamp or lamps (default = 5)
-        :param cmap: matplotlib color map to color the data (default: 'gist_earth')
+        :param cmap: matplotlib color map, or its name, to color the data (default: 'gist_earth')
         :param vmin: use to set a minimum value of the color scale 
         :param vmax: use to set a maximum value of the color scale
         :param norm: colorbar normalization function. E.g.: mpl.colors.Normalize(vmin=0.0, vmax=1.0)
         :param blend_function: function that blends shading and color (default = rbg_blending)
+        :param gradient_operator: method to calculate the terrain slopes: 'central' (default), 
+            'zevenbergen_thorne', 'horn', 'sobel' or 'scharr'. The last three are less sensitive to
+            noise. See intensity.terrain_gradient for details.
+        :param intensity_range: (low, high) intensities that are stretched to 0 and 1 to increase
+            the contrast. Default None: no stretching. When shading in tiles, calculate it for the
+            complete terrain with tiling.tile_statistics.
         
         :returns: 3D array (n_rows, n_cols, 3) with for each pixel an RGB color. 
             If blend_function=no_blending the result is a 2D array with only shading intensities.
+            If data or terrain is a chunked array, a tiling.LazyHillShade with that shape.
     """
     if terrain is None:
         terrain = data
+        
+    if is_chunked(data) or is_chunked(terrain):
+        if blend_function is no_blending:
+            norm = None # the data is not colored, so it needn't be read to scale the norm
+        elif norm is None:
+            norm = make_norm(vmin=vmin, vmax=vmax)
+        return LazyHillShade(hill_shade, data, terrain, norm=norm, 
+                             azimuth=azimuth, elevation=elevation, 
+                             ambient_weight=ambient_weight, lamp_weight=lamp_weight, 
+                             cmap=cmap, blend_function=blend_function, 
+                             gradient_operator=gradient_operator, 
+                             intensity_range=intensity_range)
     
     assert data.ndim == 2, "data must be 2 dimensional"
     assert terrain.shape == data.shape, "{} != {}".format(terrain.shape, data.shape)
     
     surface_intensity = weighted_intensity(terrain, azimuth=azimuth, elevation=elevation, 
-                                           ambient_weight=ambient_weight, lamp_weight=lamp_weight)
+                                           ambient_weight=ambient_weight, lamp_weight=lamp_weight,
+                                           gradient_operator=gradient_operator, 
+                                           intensity_range=intensity_range)
+    if blend_function is no_blending:
+        return no_blending(None, surface_intensity) # no need to color the data
         
     rgba = color_data(data, cmap=cmap, vmin=vmin, vmax=vmax, norm=norm)
     return blend_function(rgba, surface_intensity)
 
 
+def hill_shade_products(data, products, terrain=None, 
+                        azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION, 
+                        ambient_weight=DEF_AMBIENT_WEIGHT, lamp_weight=DEF_LAMP_WEIGHT, 
+                        gradient_operator=DEF_GRADIENT_OPERATOR, intensity_range=None, 
+                        tile_rows=DEF_TILE_ROWS):
+    """ Calculates several shaded reliefs (products) of the same data and terrain.
+    
+        Gives the same results as calling hill_shade for each product, but the intensities are 
+        only calculated once. The products are then colored and blended per block of tile_rows 
+        rows, so that the normalized data and colors of a block can be shared between products 
+        that use the same norm or color map while they are still in the CPU cache. Products that 
+        use no_blending don't need colors at all and get the intensities directly.
+        
+        The products parameter can be a list or a dictionary of (cmap, norm, blend_function) 
+        tuples. The cmap can be a color map or its name. If the norm is None, or not scaled, it 
+        is auto-scaled with the complete data array. Plain Normalize objects (and None norms) with 
+        the same limits share their normalized data, even if they are different objects. 
+        
+        E.g.:
+            products = {'intensity': (INTENSITY_CMAP, Normalize(0, 1), no_blending),
+                        'rgb': ('gist_earth', None, rgb_blending),
+                        'pegtop': ('gist_earth', None, pegtop_blending)}
+        
+        See hill_shade for the other parameters.
+        
+        :returns: dictionary with a hill_shade result per product. The keys are the keys of the
+            products dictionary, or the positions in the products list.
+    """
+    if terrain is None:
+        terrain = data
+    
+    assert data.ndim == 2, "data must be 2 dimensional"
+    assert terrain.shape == data.shape, "{} != {}".format(terrain.shape, data.shape)
+    assert tile_rows > 0, "tile_rows must be > 0, got: {}".format(tile_rows)
+    
+    if isinstance(products, dict):
+        product_items = list(products.items())
+    else:
+        product_items = list(enumerate(products))
+        
+    surface_intensity = weighted_intensity(terrain, azimuth=azimuth, elevation=elevation, 
+                                           ambient_weight=ambient_weight, lamp_weight=lamp_weight,
+                                           gradient_operator=gradient_operator, 
+                                           intensity_range=intensity_range)
+    
+    from matplotlib.colors import Normalize
+    
+    def norm_key(norm):
+        "Returns a key that is the same for norms that are known to normalize the same way"
+        if type(norm) is Normalize:
+            return ('Normalize', norm.vmin, norm.vmax, norm.clip)
+        return id(norm)
+    
+    results = {}
+    colored_products = []
+    cmaps_per_name = {}
+    for key, (cmap, norm, blend_function) in product_items:
+        if blend_function is no_blending:
+            results[key] = no_blending(None, surface_intensity)
+            continue
+        
+        # Scale norms with the complete data so that all blocks are colored the same.
+        if norm is None:
+            norm = make_norm()
+        if not norm.scaled():
+            norm.autoscale_None(data)
+        
+        # Color maps given by the same name become the same object, so that colors are shared.
+        if cmap is None or isinstance(cmap, str):
+            if cmap not in cmaps_per_name:
+                cmaps_per_name[cmap] = get_cmap(cmap)
+            cmap = cmaps_per_name[cmap]
+        colored_products.append((key, cmap, norm, norm_key(norm), blend_function))
+    
+    n_rows = data.shape[0]
+    for row in range(0, n_rows, tile_rows):
+        block = slice(row, min(row + tile_rows, n_rows))
+        norm_data_per_norm = {}
+        rgba_per_cmap_and_norm = {}
+        for key, cmap, norm, norm_id, blend_function in colored_products:
+            if norm_id not in norm_data_per_norm:
+                norm_data_per_norm[norm_id] = normalize(data[block], norm=norm)
+            
+            if (id(cmap), norm_id) not in rgba_per_cmap_and_norm:
+                rgba_per_cmap_and_norm[(id(cmap), norm_id)] = cmap(norm_data_per_norm[norm_id])
+            
+            rgba = rgba_per_cmap_and_norm[(id(cmap), norm_id)]
+            blended = blend_function(rgba, surface_intensity[block])
+            if key not in results:
+                results[key] = np.empty((n_rows, ) + blended.shape[1:], dtype=blended.dtype)
+            results[key][block] = blended
+            
+    return results
+
+
+def color_batch(data, cmap, vmin=None, vmax=None, norm=None):
+    """ Colors a (n_items, n_rows, n_cols) stack of data with a normalization per item.
+    
+        The vmin and vmax can be scalars, or arrays with a value per item. If they are None, the
+        minimum and maximum of each item is used. The norm can be one normalization function for 
+        all items, or a list with a norm per item. If the norm is given, vmin and vmax are ignored.
+    """
+    cmap = get_cmap(cmap)
+    if norm is not None:
+        if callable(norm):
+            return cmap(norm(data))
+        assert len(norm) == len(data), "{} != {}".format(len(norm), len(data))
+        return cmap(np.ma.stack([item_norm(item) for item_norm, item in zip(norm, data)]))
+
+    # Same calculation as mpl.colors.Normalize, but vectorized along the first axis.
+    n_items = data.shape[0]
+    data = np.asarray(data, dtype=np.float64)
+    if vmin is None:
+        vmin = np.min(data, axis=(1, 2))
+    if vmax is None:
+        vmax = np.max(data, axis=(1, 2))
+    vmin = np.broadcast_to(np.asarray(vmin, dtype=np.float64), (n_items, ))[:, None, None]
+    vmax = np.broadcast_to(np.asarray(vmax, dtype=np.float64), (n_items, ))[:, None, None]
+    assert not np.any(vmin > vmax), "minvalue must be less than or equal to maxvalue"
+    
+    # Normalize returns 0 if vmin == vmax.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        norm_data = np.where(vmin == vmax, 0.0, (data - vmin) / (vmax - vmin))
+    return cmap(norm_data)
+
+
+def hill_shade_batch(data, terrain=None, 
+                     azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION, 
+                     ambient_weight=DEF_AMBIENT_WEIGHT, lamp_weight=DEF_LAMP_WEIGHT, 
+                     cmap=None, vmin=None, vmax=None, norm=None, 
+                     blend_function=rgb_blending, gradient_operator=DEF_GRADIENT_OPERATOR,
+                     intensity_range=None, batch_pixels=DEF_BATCH_PIXELS):
+    """ Calculates the shaded reliefs of a stack of terrains in one go.
+    
+        Is equivalent to calling hill_shade for each item of the first axis, but is much faster 
+        for many small terrains since all items are processed with vectorized numpy operations.
+        
+        Each item is normalized separately. The vmin and vmax can be scalars, or arrays with a 
+        value per item. If they are None, each item is auto-scaled with its own minimum and 
+        maximum. The norm can be one normalization function for all items (note that an auto-
+        scaling norm will then scale with the complete stack), or a list with a norm per item.
+        See hill_shade for the other parameters.
+        
+        :param data: 3D array (n_items, n_rows, n_cols) with terrain properties
+        :param terrain: 3D array (n_items, n_rows, n_cols) with terrain heights
+        :param batch_pixels: the items are shaded in sub-batches of about this many pixels
+        
+        :returns: 4D array (n_items, n_rows, n_cols, 3) with for each pixel an RGB color.
+            If blend_function=no_blending the result is a 3D array with only shading intensities.
+    """
+    if terrain is None:
+        terrain = data
+    
+    assert data.ndim == 3, "data must be 3 dimensional"
+    assert terrain.shape == data.shape, "{} != {}".format(terrain.shape, data.shape)
+    
+    # Large arrays are slower than several small ones that fit in the CPU cache. Therefore the
+    # items are processed in sub-batches of about batch_pixels pixels.
+    n_items, n_rows, n_cols = data.shape
+    sub_batch_size = max(1, batch_pixels // max(1, n_rows * n_cols))
+    
+    if callable(norm) and not norm.scaled():
+        norm.autoscale_None(data) # scale with the complete stack, not with a sub-batch
+    
+    result = None
+    for start in range(0, n_items, sub_batch_size):
+        items = slice(start, min(start + sub_batch_size, n_items))
+        surface_intensity = weighted_intensity(terrain[items], 
+                                               azimuth=azimuth, elevation=elevation, 
+                                               ambient_weight=ambient_weight, 
+                                               lamp_weight=lamp_weight, 
+                                               gradient_operator=gradient_operator, 
+                                               intensity_range=intensity_range)
+        if blend_function is no_blending:
+            shaded = no_blending(None, surface_intensity)
+        else:
+            rgba = color_batch(data[items], cmap=cmap, 
+                               vmin=_item_values(vmin, items, n_items), 
+                               vmax=_item_values(vmax, items, n_items), 
+                               norm=_item_values(norm, items, n_items))
+            shaded = blend_function(rgba, surface_intensity)
+            
+        if result is None:
+            result = np.empty((n_items, ) + shaded.shape[1:], dtype=shaded.dtype)
+        result[items] = shaded
+        
+    return result
+
+
+def _item_values(values, items, n_items):
+    """ Returns the values of the items if values contains a value per item. 
+        Returns values unaltered if it is None, a scalar or a single normalization function.
+    """
+    if values is None or callable(values) or np.ndim(values) == 0:
+        return values
+    assert len(values) == n_items, "{} != {}".format(len(values), n_items)
+    return values[items]
@@ -0,0 +1,396 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Pepijn Kenter
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+""" Command line tool that hill shades DEM files in parallel.
+
+    Usage example:
+        python hillshade_cli.py render 'dems/*.npy' --output-dir shaded --format png --resume
+
+    Reads NPY files, raw binary files (use --raw-shape and --raw-dtype) and TIFF files (needs the
+    tifffile or Pillow package). Run with 'render --help' to see all options.
+
+    The output files get the directory structure of the input files, relative to --input-root
+    (default: the current directory). Input files that would give the same output file (e.g.
+    dem.npy and dem.tif) are reported as an error before anything is rendered.
+
+    The options that change the output are stored in a JSON file next to each output file. With
+    --resume, files are skipped if their output is newer than the input and has the same options.
+
+    See https://github.com/titusjan/hill_shading for updates.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from cache import default_file_mode
+from hillshade import hill_shade, get_cmap, DEF_CMAP_NAME
+from hillshade import no_blending, rgb_blending, hsv_blending, pegtop_blending
+from intensity import DEF_AZIMUTH, DEF_ELEVATION, DEF_AMBIENT_WEIGHT, DEF_LAMP_WEIGHT
+from intensity import DEF_GRADIENT_OPERATOR, GRADIENT_OPERATORS
+
+BLEND_FUNCTIONS = {'rgb': rgb_blending,
+                   'hsv': hsv_blending,
+                   'pegtop': pegtop_blending,
+                   'none': no_blending}
+
+# Options that change the output. They are stored next to each output file for --resume.
+RENDER_OPTIONS = ('azimuth', 'elevation', 'ambient_weight', 'lamp_weight', 'terrain_scale',
+                  'gradient_operator', 'cmap', 'vmin', 'vmax', 'blend')
+RAW_OPTIONS = ('raw_shape', 'raw_dtype') # only change the output of raw files
+
+RAW_EXTENSIONS = ('.raw', '.bin', '.dat')
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def read_tiff(file_name):
+    """ Reads the first band of a TIFF file with tifffile or, if that's not installed, Pillow.
+    """
+    try:
+        import tifffile
+    except ImportError:
+        pass
+    else:
+        return tifffile.imread(file_name)
+
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Reading TIFF files requires the tifffile or Pillow package")
+    return np.asarray(Image.open(file_name))
+
+
+def read_dem(file_name, raw_shape=None, raw_dtype='float32'):
+    """ Reads a 2D array of terrain heights. The file type is determined by the extension.
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.npy':
+        data = np.load(file_name)
+    elif extension in RAW_EXTENSIONS:
+        if raw_shape is None:
+            raise ValueError("The --raw-shape option is required for raw file: {}"
+                             .format(file_name))
+        data = np.fromfile(file_name, dtype=raw_dtype).reshape(raw_shape)
+    elif extension in TIFF_EXTENSIONS:
+        data = read_tiff(file_name)
+    else:
+        raise ValueError("Unsupported file type: {}".format(file_name))
+
+    if data.ndim == 3: # multi band image, use the first band
+        data = data[..., 0]
+    return data.astype(np.float64)
+
+
+def is_inside(file_name, input_root):
+    """ Returns True if the file is in the input_root directory or one of its subdirectories.
+    """
+    relative_path = os.path.relpath(os.path.abspath(file_name), os.path.abspath(input_root))
+    return not relative_path.startswith(os.pardir)
+
+
+def output_file_name(file_name, output_dir, output_format, input_root):
+    """ Returns the name of the output file of an input file. The directory of the input file
+        relative to the input_root is kept, so that input files with the same name in different
+        directories don't overwrite each other's output. The result only depends on the input
+        file, not on which other files are rendered, so that --resume finds the same output.
+    """
+    sub_dir = os.path.relpath(os.path.dirname(os.path.abspath(file_name)),
+                              os.path.abspath(input_root))
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    return os.path.normpath(os.path.join(output_dir, sub_dir, "{}.{}".format(stem, output_format)))
+
+
+def find_collisions(file_names, output_dir, output_format, input_root):
+    """ Returns a dictionary that maps each output file that is shared by several input files
+        (e.g. dem.npy and dem.tif) to the list of those input files.
+    """
+    inputs_per_output = {}
+    for file_name in file_names:
+        output_file = output_file_name(file_name, output_dir, output_format, input_root)
+        inputs_per_output.setdefault(output_file, []).append(file_name)
+    return {output_file: inputs for output_file, inputs in inputs_per_output.items()
+            if len(inputs) > 1}
+
+
+def render_settings(options, file_name):
+    """ Returns a dictionary with the input file and the options that change the output, as
+        they are stored in the settings file.
+    """
+    option_names = RENDER_OPTIONS
+    if os.path.splitext(file_name)[1].lower() in RAW_EXTENSIONS:
+        option_names += RAW_OPTIONS
+    settings = {name: getattr(options, name) for name in option_names}
+    settings['input_file'] = os.path.abspath(file_name)
+    return json.loads(json.dumps(settings)) # tuples become lists, as when read back
+
+
+def settings_file_name(output_file):
+    """ Returns the name of the file in which the render settings of an output file are stored.
+    """
+    return output_file + '.json'
+
+
+def is_up_to_date(file_name, output_file, settings):
+    """ Returns True if the output file exists, is newer than the input file, and was rendered
+        with the same settings.
+    """
+    try:
+        if os.path.getmtime(output_file) < os.path.getmtime(file_name):
+            return False
+        with open(settings_file_name(output_file)) as settings_file:
+            return json.load(settings_file) == settings
+    except (OSError, ValueError):
+        return False
+
+
+def write_atomically(output_file, write_function):
+    """ Calls write_function with the name of a temporary file and renames that file to the
+        output_file, so that an interrupted run never leaves a partial file behind. The file gets
+        the permissions of a regular new file (mkstemp makes it readable for the owner only).
+    """
+    output_dir = os.path.dirname(output_file) or '.'
+    file_descriptor, temp_file_name = tempfile.mkstemp(
+        dir=output_dir, prefix='.', suffix=os.path.splitext(output_file)[1])
+    os.close(file_descriptor)
+    try:
+        write_function(temp_file_name)
+        os.chmod(temp_file_name, default_file_mode())
+        os.replace(temp_file_name, output_file)
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
+
+
+def write_settings(settings, output_file):
+    """ Writes the render settings of the output file. Must be called after the output file is
+        written, so that an interrupted run never leaves an output with wrong settings behind.
+    """
+    def write_function(file_name):
+        with open(file_name, 'w') as settings_file:
+            json.dump(settings, settings_file, indent=4, sort_keys=True)
+
+    write_atomically(settings_file_name(output_file), write_function)
+
+
+def write_output(result, output_file, output_format):
+    """ Writes the result as PNG or NPY file.
+    """
+    def write_function(file_name):
+        if output_format == 'npy':
+            np.save(file_name, result)
+        else:
+            from matplotlib.image import imsave # no pyplot needed
+            imsave(file_name, np.clip(result, 0.0, 1.0), cmap='gray',
+                   vmin=0.0, vmax=1.0, format='png')
+
+    write_atomically(output_file, write_function)
+
+
+def init_worker(options):
+    """ Imports matplotlib in the worker process before the first file is rendered, so that the
+        import time is not included in the timing of that file.
+    """
+    if options.blend != 'none':
+        get_cmap(options.cmap)(0.0)
+    if options.format == 'png':
+        import matplotlib.image
+
+
+def render_file(file_name, options):
+    """ Hill shades one file. Is called in the worker processes.
+
+        Returns a (file_name, output_file, n_pixels, duration) tuple. The duration is None if the
+        file was skipped because its output is up to date.
+    """
+    output_file = output_file_name(file_name, options.output_dir, options.format,
+                                   options.input_root)
+    settings = render_settings(options, file_name)
+    if options.resume and is_up_to_date(file_name, output_file, settings):
+        return file_name, output_file, 0, None
+
+    start = time.perf_counter()
+    data = read_dem(file_name, raw_shape=options.raw_shape, raw_dtype=options.raw_dtype)
+    result = hill_shade(data, terrain=data * options.terrain_scale,
+                        azimuth=options.azimuth, elevation=options.elevation,
+                        ambient_weight=options.ambient_weight, lamp_weight=options.lamp_weight,
+                        cmap=options.cmap, vmin=options.vmin, vmax=options.vmax,
+                        blend_function=BLEND_FUNCTIONS[options.blend],
+                        gradient_operator=options.gradient_operator)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    write_output(result, output_file, options.format)
+    write_settings(settings, output_file)
+    return file_name, output_file, data.size, time.perf_counter() - start
+
+
+def find_files(patterns):
+    """ Returns the sorted list of files that match the glob patterns.
+    """
+    file_names = set()
+    for pattern in patterns:
+        file_names.update(glob.glob(pattern))
+    return sorted(file_names)
+
+
+def render(options):
+    """ Hill shades all files that match the glob patterns. Returns the number of failures.
+    """
+    file_names = find_files(options.patterns)
+    if not file_names:
+        print("No files match: {}".format(' '.join(options.patterns)), file=sys.stderr)
+        return 1
+
+    outside = [file_name for file_name in file_names
+               if not is_inside(file_name, options.input_root)]
+    if outside:
+        print("Input files must be inside the input root {}: {}"
+              .format(options.input_root, ', '.join(outside)), file=sys.stderr)
+        return 1
+
+    collisions = find_collisions(file_names, options.output_dir, options.format,
+                                 options.input_root)
+    if collisions:
+        for output_file, inputs in sorted(collisions.items()):
+            print("Several input files have the same output file {}: {}"
+                  .format(output_file, ', '.join(inputs)), file=sys.stderr)
+        return 1
+
+    if not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    n_rendered, n_skipped, n_failed, n_pixels = 0, 0, 0, 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=options.jobs, initializer=init_worker,
+                             initargs=(options, )) as executor:
+        futures = {executor.submit(render_file, file_name, options): file_name
+                   for file_name in file_names}
+        for future in as_completed(futures):
+            try:
+                file_name, output_file, file_pixels, duration = future.result()
+            except Exception as ex:
+                n_failed += 1
+                print("FAILED  {}: {}".format(futures[future], ex), file=sys.stderr)
+                continue
+
+            if duration is None:
+                n_skipped += 1
+                print("skipped {} (up to date)".format(output_file))
+            else:
+                n_rendered += 1
+                n_pixels += file_pixels
+                print("{:7.3f} s {:8.2f} Mpix/s  {} -> {}".format(
+                    duration, file_pixels / duration / 1e6, file_name, output_file))
+
+    total_duration = time.perf_counter() - start
+    print("Rendered {} files ({} skipped, {} failed) in {:.3f} s: {:.2f} files/s, {:.2f} Mpix/s"
+          .format(n_rendered, n_skipped, n_failed, total_duration,
+                  n_rendered / total_duration, n_pixels / total_duration / 1e6))
+    return n_failed
+
+
+def make_parser():
+    """ Returns the argument parser of the command line tool.
+    """
+    parser = argparse.ArgumentParser(description="Hill shading of DEM files.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    render_parser = subparsers.add_parser(
+        'render', help="hill shade files", description="Hill shades DEM files in parallel.")
+    render_parser.add_argument('patterns', nargs='+', metavar='PATTERN',
+                               help="glob pattern of the input files (NPY, raw or TIFF)")
+    render_parser.add_argument('-o', '--output-dir', default='.',
+                               help="directory of the output files (default: current directory)."
+                                    " The directory structure below --input-root is kept.")
+    render_parser.add_argument('--input-root', default='.',
+                               help="directory of which the structure is kept under the output"
+                                    " directory. All input files must be inside it"
+                                    " (default: current directory)")
+    render_parser.add_argument('-f', '--format', choices=['png', 'npy'], default='png',
+                               help="output format (default: png)")
+    render_parser.add_argument('-j', '--jobs', type=int, default=None,
+                               help="number of worker processes (default: number of CPUs)")
+    render_parser.add_argument('--resume', action='store_true',
+                               help="skip files of which the output is newer than the input and"
+                                    " was rendered with the same options. The options are stored"
+                                    " in a JSON file next to each output file.")
+
+    render_parser.add_argument('--raw-shape', type=int, nargs=2, metavar=('ROWS', 'COLS'),
+                               help="shape of the arrays in raw files")
+    render_parser.add_argument('--raw-dtype', default='float32',
+                               help="data type of raw files (default: float32)")
+
+    render_parser.add_argument('--azimuth', type=float, nargs='+', default=[DEF_AZIMUTH],
+                               help="azimuth angle(s) of the lamp(s) in degrees")
+    render_parser.add_argument('--elevation', type=float, nargs='+', default=[DEF_ELEVATION],
+                               help="elevation angle(s) of the lamp(s) in degrees")
+    render_parser.add_argument('--ambient-weight', type=float, default=DEF_AMBIENT_WEIGHT,
+                               help="strength of the ambient light")
+    render_parser.add_argument('--lamp-weight', type=float, nargs='+', default=[DEF_LAMP_WEIGHT],
+                               help="strength of the lamp(s)")
+    render_parser.add_argument('--terrain-scale', type=float, default=1.0,
+                               help="factor to scale the terrain heights with for the shading")
+    render_parser.add_argument('--gradient-operator', default=DEF_GRADIENT_OPERATOR,
+                               choices=sorted(GRADIENT_OPERATORS.keys()),
+                               help="method to calculate the slopes")
+
+    render_parser.add_argument('--cmap', default=DEF_CMAP_NAME,
+                               help="name of the matplotlib color map")
+    render_parser.add_argument('--vmin', type=float, help="minimum of the color scale")
+    render_parser.add_argument('--vmax', type=float, help="maximum of the color scale")
+    render_parser.add_argument('--blend', choices=sorted(BLEND_FUNCTIONS.keys()), default='rgb',
+                               help="blend function ('none' only gives the intensities)")
+    return parser
+
+
+def check_options(parser, options):
+    """ Checks the render options that can only be checked after parsing. Calls parser.error, which
+        exits, if an option is invalid. This is done before the worker processes are started,
+        so that an error is reported once instead of once per worker or file.
+    """
+    if len(options.elevation) != len(options.azimuth):
+        parser.error("--elevation needs as many values as --azimuth ({}), got {}"
+                     .format(len(options.azimuth), len(options.elevation)))
+    if len(options.lamp_weight) not in (1, len(options.azimuth)):
+        parser.error("--lamp-weight needs one value or as many values as --azimuth ({}), got {}"
+                     .format(len(options.azimuth), len(options.lamp_weight)))
+    if options.blend != 'none':
+        try:
+            get_cmap(options.cmap)
+        except (ValueError, KeyError) as ex:
+            parser.error("invalid --cmap {!r}: {}".format(options.cmap, ex))
+
+
+def main():
+    parser = make_parser()
+    options = parser.parse_args()
+    if options.command == 'render':
+        check_options(parser, options)
+        return 1 if render(options) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
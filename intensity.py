@@ -35,12 +35,28 @@ DEF_ELEVATION = 45  # degrees
 DEF_AMBIENT_WEIGHT = 1
 DEF_LAMP_WEIGHT = 5
 
+# The gradient operators are given by the weights of the smoothing perpendicular to the central 
+# difference. E.g. Horn's method smooths the row differences of the columns left, center and right 
+# with weights 1, 2 and 1. Horn's method is the Sobel operator scaled to unit pixel distances. 
+# The Zevenbergen-Thorne method is the central difference without smoothing, just as np.gradient.
+GRADIENT_OPERATORS = {
+    'central': None,               # np.gradient
+    'zevenbergen_thorne': (0, 1, 0),
+    'horn': (1, 2, 1),
+    'sobel': (1, 2, 1),
+    'scharr': (3, 10, 3),
+}
+DEF_GRADIENT_OPERATOR = 'central'
+GRADIENT_HALO = 1 # All gradient operators use the pixels at distance 1.
+GRADIENT_BLOCK_PIXELS = 16384 # number of pixels that terrain_gradient processes in one go
+
 DO_SANITY_CHECKS = True # If True intermediate results will be checked for boundary values.
 
     
 def weighted_intensity(terrain,  
                        azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION, 
-                       ambient_weight=DEF_AMBIENT_WEIGHT, lamp_weight=DEF_LAMP_WEIGHT):
+                       ambient_weight=DEF_AMBIENT_WEIGHT, lamp_weight=DEF_LAMP_WEIGHT,
+                       gradient_operator=DEF_GRADIENT_OPERATOR, intensity_range=None):
     """ Calculates weighted average of the ambient illumination and the that of one or more lamps.
     
         The azimuth and elevation parameters can be scalars or lists. Use the latter for multiple 
@@ -49,6 +65,15 @@ def weighted_intensity(terrain,
         The lamp_weight can be given per lamp or one value can be specified, which is then used for
         all lamps sources.
         
+        The terrain may have extra leading dimensions, for instance to calculate the intensities of
+        a stack of terrains at once. The intensities are calculated over the last two dimensions.
+        
+        The gradient_operator is the name of the method to calculate the terrain slopes. See 
+        terrain_gradient for the possible values.
+        
+        If intensity_range is given, the intensities are stretched with it to increase the 
+        contrast. See stretch_intensity.
+        
         See also the hill_shade doc string.
     """
     # Make sure input is in the correct shape
@@ -61,41 +86,76 @@ def weighted_intensity(terrain,
         lamp_weights = lamp_weights * len(azimuths) 
     assert_same_length(azimuths, lamp_weights, 'azimuths', 'lamp_weights')
 
-    # Create weights and rel_intensities arrays   
-    rel_intensities = [np.ones_like(terrain)]
-    weights = [ambient_weight] 
-    for azim, elev, lmpw in zip(azimuths, elevations, lamp_weights):
-        rel_int = relative_surface_intensity(terrain, azimuth=azim, elevation=elev)
-        rel_intensities.append(rel_int)
-        weights.append(lmpw)
-    
-    rel_intensities = np.dstack(rel_intensities)
-    weights = np.array(weights)
+    # Calculate the relative intensities of all lamps at once: shape = (..., n_lamps) 
+    dr, dc = terrain_gradient(terrain, gradient_operator=gradient_operator)
+    lights = np.array([polar_to_cart3d(azim, elev) for azim, elev in zip(azimuths, elevations)])
+    rel_intensities = gradient_intensity(dr, dc, lights.reshape(-1, 3))
     
-    # The actual weighted-average calculation
+    # The actual weighted-average calculation. The ambient light has relative intensity 1.
+    weights = np.array([ambient_weight] + lamp_weights, dtype=np.float64)
     unit_weights = weights / np.sum(weights)
-    surface_intensity = np.average(rel_intensities, axis=2, weights=unit_weights)
+    surface_intensity = unit_weights[0] + np.sum(rel_intensities * unit_weights[1:], axis=-1)
+    
+    if intensity_range is not None:
+        surface_intensity = stretch_intensity(surface_intensity, intensity_range)
     return surface_intensity
 
 
-def relative_surface_intensity(terrain, azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION):
+def stretch_intensity(intensity, intensity_range):
+    """ Linearly stretches the intensities so that intensity_range[0] becomes 0 and 
+        intensity_range[1] becomes 1. The result is clipped between 0 and 1.
+        
+        When shading in tiles, use the same range for all tiles (e.g. percentiles calculated with 
+        tiling.tile_statistics) to prevent brightness jumps between the tiles.
+        
+        If both limits are equal, e.g. for flat terrain, the result is 0 everywhere. This is the
+        same as matplotlib's Normalize does when vmin equals vmax.
+    """
+    low, high = intensity_range
+    assert high >= low, "intensity_range must be increasing, got: {}".format(intensity_range)
+    if high == low:
+        return np.zeros_like(intensity)
+    return np.clip((intensity - low) / (high - low), 0.0, 1.0)
+
+
+def relative_surface_intensity(terrain, azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION, 
+                               gradient_operator=DEF_GRADIENT_OPERATOR):
     """ Calculates the intensity that falls on the surface for light of intensity 1. 
         This equals cosine(theta) where theta is the angle between the direction of the light 
         source and the surface normal. When the cosine is negative, the angle is > 90 degrees. 
         In that case the surface receives no light so we clip to 0. The result of this function is 
         therefore always between 0 and 1.
     """
+    dr, dc = terrain_gradient(terrain, gradient_operator=gradient_operator)
+    light = polar_to_cart3d(azimuth, elevation)
+    return gradient_intensity(dr, dc, light[np.newaxis, :])[..., 0]
+    
+    
+def gradient_intensity(dr, dc, lights):
+    """ Calculates the relative intensity, cosine(theta), for each pixel and each light.
+        See relative_surface_intensity.
+        
+        The surface normals are calculated from the gradients on the fly (see 
+        surface_unit_normals), so that the array with all normal vectors is never created.
+    
+        :param dr: array with the terrain gradient in the row direction 
+        :param dc: array with the terrain gradient in the column direction 
+        :param lights: array of shape (n_lamps, 3) with the unit vectors towards the lamps
+        :returns: array of shape dr.shape + (n_lamps, ) with values between 0 and 1
+    """
     # cosine(theta) is the dot-product of the normal vector and the vector that contains the  
     # direction of the light source. Both vectors must be unit vectors (have length 1).
-    normals = surface_unit_normals(terrain)
-    light = polar_to_cart3d(azimuth, elevation)
-    intensity = np.dot(normals, light)
+    # The normal vector is (1, -dr, -dc) / normal_magnitude.
+    dr = np.expand_dims(dr, axis=-1)
+    dc = np.expand_dims(dc, axis=-1)
+    normal_magnitudes = np.sqrt(1.0 + dr ** 2 + dc ** 2)
+    intensity = (lights[:, 0] - dr * lights[:, 1] - dc * lights[:, 2]) / normal_magnitudes
     
     if DO_SANITY_CHECKS:
-        np.testing.assert_approx_equal(np.linalg.norm(light), 1.0, 
-                                       err_msg="sanity check: light vector should have length 1")
-        assert np.all(intensity >= -1.0), "sanity check: cos(theta) should be >= -1"
-        assert np.all(intensity <= 1.0), "sanity check: cos(theta) should be <= 1"
+        assert np.allclose(np.linalg.norm(lights, axis=-1), 1.0), \
+            "sanity check: light vectors should have length 1"
+        assert np.all(intensity >= -1.0 - 1e-12), "sanity check: cos(theta) should be >= -1"
+        assert np.all(intensity <= 1.0 + 1e-12), "sanity check: cos(theta) should be <= 1"
     
     # Where the dot product is smaller than 0 the angle between the light source and the surface
     # is larger than 90 degrees. These pixels receive no light so we clip the intensity to 0.
@@ -103,25 +163,102 @@ def relative_surface_intensity(terrain, azimuth=DEF_AZIMUTH, elevation=DEF_ELEVA
     return intensity
     
     
-def surface_unit_normals(terrain):
-    """ Returns an array of shape (n_rows, n_cols, 3) with unit surface normals. 
-        That is, each result[r,c,:] contains the vector of length 1, perpendicular to the surface.
-    """ 
-    dr, dc = np.gradient(terrain)
+def terrain_gradient(terrain, gradient_operator=DEF_GRADIENT_OPERATOR):
+    """ Returns the (dr, dc) gradients of the terrain in the row and column direction.
+    
+        The gradient_operator can be:
+            'central': second order central differences as calculated by np.gradient (default).
+            'zevenbergen_thorne': the same central differences.
+            'horn' or 'sobel': central differences of which the perpendicular neighbours are 
+                averaged with weights 1, 2, 1. This is less sensitive to noise.
+            'scharr': idem with weights 3, 10, 3, which is more rotationally symmetric.
+                
+        All operators only use the neighbours at distance 1 (see GRADIENT_HALO). Except for
+        'central', the terrain is extended with one pixel on each side by point reflection.
+        This gives the same one-sided differences at the edges as np.gradient does. The 
+        differences are calculated from shifted views of the extended terrain and accumulated in 
+        the result arrays in place, per block of about GRADIENT_BLOCK_PIXELS pixels that stays in 
+        the CPU cache. Apart from the results, only the extended terrain and a buffer of one 
+        block are allocated.
+        
+        The terrain may have extra leading dimensions, the gradients are calculated over the last
+        two dimensions.
+    """
+    try:
+        smoothing = GRADIENT_OPERATORS[gradient_operator]
+    except KeyError:
+        raise ValueError("Invalid gradient operator: {!r}".format(gradient_operator))
+    
+    if smoothing is None:
+        return np.gradient(terrain, axis=(-2, -1))
+    
+    pad_width = [(0, 0)] * (terrain.ndim - 2) + [(1, 1), (1, 1)]
+    padded = np.pad(terrain, pad_width, mode='reflect', reflect_type='odd')
+    dtype = padded.dtype if np.issubdtype(padded.dtype, np.floating) else np.float64
     
-    # Vectors that do a step of 1 in the row direction, 0 in the column direction and dr upwards
-    vr = np.dstack((dr, np.ones_like(dr), np.zeros_like(dr)))   # shape = (n_rows, n_cols, 3)
+    dr = np.empty(terrain.shape, dtype=dtype)
+    dc = np.empty(terrain.shape, dtype=dtype)
     
-    # Vectors that do a step of 0 in the row direction, 1 in the column direction and dc upwards
-    vc = np.dstack((dc, np.zeros_like(dc), np.ones_like(dc)))   # shape = (n_rows, n_cols, 3)
+    # Work per block of rows, so that the block and its buffer stay in the CPU cache.
+    n_rows, n_cols = terrain.shape[-2:]
+    n_leading = int(np.prod(terrain.shape[:-2]))
+    block_rows = max(1, GRADIENT_BLOCK_PIXELS // max(1, n_cols * n_leading))
+    buffer = np.empty(terrain.shape[:-2] + (min(block_rows, n_rows), n_cols), dtype=dtype)
+    for row in range(0, n_rows, block_rows):
+        end_row = min(row + block_rows, n_rows)
+        padded_block = padded[..., row:end_row + 2, :]
+        block_buffer = buffer[..., :end_row - row, :]
+        _smoothed_difference(padded_block, (1, 0), smoothing, dr[..., row:end_row, :], block_buffer)
+        _smoothed_difference(padded_block, (0, 1), smoothing, dc[..., row:end_row, :], block_buffer)
+    return dr, dc
 
-    # The surface normals can be calculated as the cross product of those vector pairs
-    surface_normals = np.cross(vr, vc)  # surface_normals.shape = (n_rows, n_cols, 3)
+
+def _smoothed_difference(padded, direction, smoothing, out, buffer):
+    """ Calculates the central differences of the padded terrain in the (row, col) direction, 
+        smoothed perpendicular to it with the (side, center, side) weights of smoothing, in out.
+    """
+    n_rows, n_cols = padded.shape[-2] - 2, padded.shape[-1] - 2
+    
+    def shifted(row, col):
+        "Returns the view of the padded terrain shifted by (row, col), with the terrain's shape"
+        return padded[..., 1 + row:n_rows + 1 + row, 1 + col:n_cols + 1 + col]
+    
+    step_r, step_c = direction
+    side_r, side_c = step_c, step_r # perpendicular to the direction
+    side_weight, center_weight, _ = smoothing
+    scale = 0.5 / (2 * side_weight + center_weight)
+    
+    np.subtract(shifted(step_r, step_c), shifted(-step_r, -step_c), out=out)
+    np.multiply(out, center_weight * scale, out=out)
+    if side_weight == 0:
+        return out
+    
+    np.subtract(shifted(step_r - side_r, step_c - side_c), 
+                shifted(-step_r - side_r, -step_c - side_c), out=buffer)
+    np.add(buffer, shifted(step_r + side_r, step_c + side_c), out=buffer)
+    np.subtract(buffer, shifted(-step_r + side_r, -step_c + side_c), out=buffer)
+    np.multiply(buffer, side_weight * scale, out=buffer)
+    np.add(out, buffer, out=out)
+    return out
+    
+    
+def surface_unit_normals(terrain, gradient_operator=DEF_GRADIENT_OPERATOR):
+    """ Returns an array of shape (n_rows, n_cols, 3) with unit surface normals. 
+        That is, each result[r,c,:] contains the vector of length 1, perpendicular to the surface.
+        
+        The terrain may have extra leading dimensions, the normals are calculated over the last 
+        two dimensions. E.g. a (n_terrains, n_rows, n_cols) terrain gives (n_terrains, n_rows,
+        n_cols, 3) normals.
+    """ 
+    dr, dc = terrain_gradient(terrain, gradient_operator=gradient_operator)
     
+    # The surface normals are the cross product of the vectors (dr, 1, 0) and (dc, 0, 1), which 
+    # do a step of 1 in the row, respectively column, direction and go dr, respectively dc, 
+    # upwards. Written out, this cross product is (1, -dr, -dc). 
     # Divide the normals by their magnitude to get unit vectors. 
-    # (Add artificial dimension of length 1 so that we can use broadcasting)
-    normal_magnitudes = np.linalg.norm(surface_normals, axis=2)
-    return surface_normals / np.expand_dims(normal_magnitudes, axis=2)  
+    normal_magnitudes = np.sqrt(1.0 + dr ** 2 + dc ** 2)
+    return np.stack((1.0 / normal_magnitudes, -dr / normal_magnitudes, -dc / normal_magnitudes), 
+                    axis=-1) # shape = (..., 3)
 
 
 def polar_to_cart3d(azimuth, elevation):
@@ -4,13 +4,13 @@
 from __future__ import print_function
 from __future__ import division
 
+import math
 import numpy as np
 import matplotlib as mpl
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from mpl_toolkits.mplot3d import axes3d
 
-from intensity import mpl_surface_intensity
-from hillshade import DEF_AZIMUTH, DEF_ELEVATION, DEF_CMAP, color_data, rgb_blending
+from intensity import mpl_surface_intensity, GRADIENT_HALO
+from hillshade import DEF_AZIMUTH, DEF_ELEVATION, color_data, rgb_blending
+from hillshade import hill_shade, get_cmap, make_norm
 
 DEF_SCALE = 10.0
 #IMSHOW_INTERP = 'nearest'
@@ -32,6 +32,8 @@ def _generate_concentric_circles(size):
 
 def _generate_hills(size):
     "Generates noisy hills test data"
+    from mpl_toolkits.mplot3d import axes3d # imported here since it is slow to import
+    
     _, _, data = axes3d.get_test_data(6.0 / size)  
     return -0.1 * data # to make in about the same height as the circles
 
@@ -61,13 +63,15 @@ def add_colorbar(axes, cmap, norm=None, vmin=None, vmax=None, label=''):
     if norm is None:
         norm = mpl.colors.Normalize(vmin=vmin, vmax=vmax)
             
+    from mpl_toolkits.axes_grid1 import make_axes_locatable # imported here since it is slow
+    
     assert cmap, "cmap undefined"
     assert norm.scaled(), "Norm function must be scaled to prevent side effects"
     #print("cnorm.vmin: {}".format(norm.vmin))
     #print("cnorm.vmax: {}".format(norm.vmax))
         
     divider = make_axes_locatable(axes)    
-    colorbar_axes = divider.append_axes('right', size="5%", pad=0.25, add_to_figure=True)
+    colorbar_axes = divider.append_axes('right', size="5%", pad=0.25) # adds it to the figure
     
     # mpl.colorbar.ColorbarBase can have side effects on norm if norm is auto scaling!
     colorbar = mpl.colorbar.ColorbarBase(colorbar_axes, cmap=cmap, norm=norm, label=label, 
@@ -104,12 +108,160 @@ def draw(axes, image_data, title='',
         remove_ticks(axes)    
         
 
+class ViewportHillShade(object):
+    """ Hill shaded image of which only the visible part is shaded, at screen resolution.
+    
+        Use this for interactive viewing of large terrains. When the user pans or zooms, the 
+        visible part of the data is decimated to about the number of screen pixels of the axes, 
+        shaded, and put in the existing image. No new artists are created. Only when zoomed in so
+        far that there are fewer data pixels than screen pixels, the data is shaded at full 
+        resolution.
+        
+        Changing the axes limits only marks the image as out of date. It is shaded once, with the
+        final limits, at the next draw of the canvas. A zoom, which changes both the x and the y
+        limits, therefore shades only once. Call update() to shade immediately, e.g. before 
+        saving a figure of which the limits were changed by the program.
+        
+        The decimated terrain is divided by the decimation step so that the slopes, and therefore 
+        the shading, don't change with the zoom level. The view is shaded with a halo of one 
+        (decimated) pixel on each side, which is cropped afterwards, so that the borders of the 
+        view are shaded the same as in the complete image. If the norm is not scaled, it is 
+        scaled with the complete data once, at construction time. 
+        
+        The shade_kwargs are passed to hill_shade (e.g. azimuth or blend_function).
+    """
+    def __init__(self, axes, data, terrain=None, 
+                 cmap=None, vmin=None, vmax=None, norm=None, 
+                 interpolation=IMSHOW_INTERP, origin=IMSHOW_ORIGIN, 
+                 colorbar=True, **shade_kwargs):
+        if terrain is None:
+            terrain = data
+            
+        assert data.ndim == 2, "data must be 2 dimensional"
+        assert terrain.shape == data.shape, "{} != {}".format(terrain.shape, data.shape)
+        
+        if norm is None:
+            norm = make_norm(vmin=vmin, vmax=vmax)
+        if not norm.scaled():
+            norm.autoscale_None(data)
+            
+        self.axes = axes
+        self.data = data
+        self.terrain = terrain
+        self.cmap = get_cmap(cmap)
+        self.norm = norm
+        self.origin = origin
+        self.shade_kwargs = shade_kwargs
+        self._view = None
+        self._is_dirty = False
+        
+        n_rows, n_cols = data.shape
+        self.image = axes.imshow(np.zeros((1, 1)), cmap=self.cmap, norm=self.norm, 
+                                 interpolation=interpolation, origin=origin, 
+                                 extent=self._extent(0, n_rows, 0, n_cols))
+        
+        # Changing the extent of the image must not change the axes limits.
+        axes.set_autoscale_on(False)
+        if colorbar:
+            add_colorbar(axes, self.cmap, norm=self.norm)
+            
+        self.update()
+        axes.callbacks.connect('xlim_changed', self._limits_changed)
+        axes.callbacks.connect('ylim_changed', self._limits_changed)
+        axes.figure.canvas.mpl_connect('draw_event', self._on_draw)
+        
+    def _extent(self, row_start, row_end, col_start, col_end):
+        """ Returns the imshow extent of a block of pixels.
+        """
+        left, right = col_start - 0.5, col_end - 0.5
+        bottom, top = row_start - 0.5, row_end - 0.5
+        if self.origin == 'upper':
+            bottom, top = top, bottom
+        return (left, right, bottom, top)
+            
+    def visible_view(self):
+        """ Returns the (row_start, row_end, col_start, col_end, step) of the part of the data 
+            that is visible. The step is the decimation that gives about one data pixel per 
+            screen pixel. The start values are multiples of the step, so that panning does not 
+            change which pixels are drawn.
+        """
+        n_rows, n_cols = self.data.shape
+        x_min, x_max = sorted(self.axes.get_xlim())
+        y_min, y_max = sorted(self.axes.get_ylim())
+        
+        col_start = int(min(max(math.floor(x_min + 0.5), 0), n_cols - 1))
+        col_end = int(max(min(math.ceil(x_max + 0.5), n_cols), col_start + 1))
+        row_start = int(min(max(math.floor(y_min + 0.5), 0), n_rows - 1))
+        row_end = int(max(min(math.ceil(y_max + 0.5), n_rows), row_start + 1))
+        
+        # Use the original position. The active position shrinks when the aspect ratio is fixed and
+        # only one of the axis limits has been updated yet.
+        figure = self.axes.figure
+        window = figure.transFigure.transform_bbox(self.axes.get_position(original=True))
+        step = max(1, int(max((col_end - col_start) / max(window.width, 1), 
+                              (row_end - row_start) / max(window.height, 1))))
+        
+        # Take at least two pixels in each direction, needed for the gradient.
+        row_start = max(0, min((row_start // step) * step, n_rows - 2 * step))
+        col_start = max(0, min((col_start // step) * step, n_cols - 2 * step))
+        row_end = min(n_rows, max(row_end, row_start + 2 * step))
+        col_end = min(n_cols, max(col_end, col_start + 2 * step))
+        return row_start, row_end, col_start, col_end, step
+        
+    def _limits_changed(self, _axes=None):
+        """ Marks the image as out of date. Is called when the axes limits change. No draw is
+            requested here: the toolbar and pyplot already redraw the figure after a change.
+        """
+        self._is_dirty = True
+        
+    def _on_draw(self, _event=None):
+        """ Shades the image if the limits have changed since it was shaded. Is called after the
+            canvas is drawn.
+        """
+        if self._is_dirty:
+            self.update()
+            
+    def update(self):
+        """ Shades the visible part of the data and puts it in the image (if it has changed).
+        """
+        self._is_dirty = False
+        view = self.visible_view()
+        if view == self._view:
+            return
+        self._view = view
+        
+        row_start, row_end, col_start, col_end, step = view
+        n_rows, n_cols = self.data.shape
+        halo = GRADIENT_HALO * step
+        
+        # The starts are multiples of the step, so the halo is on the same decimated grid.
+        row_outer_start, col_outer_start = max(0, row_start - halo), max(0, col_start - halo)
+        rows = slice(row_outer_start, min(n_rows, row_end + halo), step)
+        cols = slice(col_outer_start, min(n_cols, col_end + halo), step)
+        data_outer = self.data[rows, cols] 
+        terrain_outer = self.terrain[rows, cols] / step # keep the slopes the same
+        
+        shaded = hill_shade(data_outer, terrain=terrain_outer, 
+                            cmap=self.cmap, norm=self.norm, **self.shade_kwargs)
+        
+        n_view_rows = len(range(row_start, row_end, step))
+        n_view_cols = len(range(col_start, col_end, step))
+        first_row = (row_start - row_outer_start) // step
+        first_col = (col_start - col_outer_start) // step
+        shaded = shaded[first_row:first_row + n_view_rows, first_col:first_col + n_view_cols]
+        
+        self.image.set_data(shaded)
+        self.image.set_extent(self._extent(row_start, row_start + n_view_rows * step, 
+                                           col_start, col_start + n_view_cols * step))
+        self.axes.figure.canvas.draw_idle()
+
+
 ########
 # misc #
 ########
     
 def mpl_hill_shade(data, terrain=None, 
-                   cmap=DEF_CMAP, vmin=None, vmax=None, norm=None, blend_function=rgb_blending,  
+                   cmap=None, vmin=None, vmax=None, norm=None, blend_function=rgb_blending,  
                    azimuth=DEF_AZIMUTH, elevation=DEF_ELEVATION):
     """ Hill shading that uses the matplotlib intensities. Is only for making comparison between
         blending methods where we need to include the matplotlib hill shading. For all other
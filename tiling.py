@@ -0,0 +1,438 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Pepijn Kenter
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+""" Lazy, tiled hill shading of large (chunked) arrays.
+
+    The hill_shade function returns a LazyHillShade object when it gets a chunked array, such as
+    a zarr or dask array, or a ChunkedArray that wraps a memory-mapped NPY file. Nothing is
+    calculated until the result is materialized with compute(), to_npy() or np.asarray().
+
+    Each tile is shaded together with a border (the halo) of its neighbouring pixels so that
+    the gradient stencil sees the same values as it would for the whole array. The halo is
+    cropped afterwards. This makes the tiled result identical to shading the array in one go.
+
+    To color and stretch all tiles consistently, the tile_statistics function calculates the
+    minimum, maximum and percentiles of the data and the intensities of all tiles in one pass.
+
+    See https://github.com/titusjan/hill_shading for updates.
+"""
+
+import copy
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from intensity import GRADIENT_HALO, weighted_intensity
+
+DEF_CHUNKS = (1024, 1024)
+DEF_HALO = GRADIENT_HALO # pixels needed on each side of a tile by the gradient operators
+DEF_SAMPLE_SIZE = 65536  # number of values that StreamingStatistics keeps for the percentiles
+
+
+Tile = namedtuple('Tile', ['core', 'outer', 'crop'])
+Tile.__doc__ = """ Location of a tile.
+
+    core: the slices of the tile in the complete array (without halo)
+    outer: the slices of the tile including the halo (this part is read and shaded)
+    crop: the slices that select the core from the shaded outer part
+"""
+
+
+def is_chunked(array):
+    """ Returns True if the array is a chunked array (e.g. a zarr, dask or ChunkedArray object).
+        Regular numpy arrays (including memory maps) are not considered chunked.
+    """
+    return (array is not None and not isinstance(array, np.ndarray) and
+            hasattr(array, 'chunks') and hasattr(array, 'shape'))
+
+
+def chunk_shape(array, default=DEF_CHUNKS):
+    """ Returns the (n_rows, n_cols) chunk shape of an array.
+
+        Zarr arrays store their chunks as a tuple of ints, dask arrays as a tuple with the block
+        sizes per dimension. In the latter case the largest block size is used.
+    """
+    chunks = getattr(array, 'chunks', None)
+    if chunks is None:
+        return tuple(default)
+
+    result = []
+    for chunk in chunks:
+        try:
+            result.append(int(max(chunk))) # dask: tuple of block sizes per dimension
+        except TypeError:
+            result.append(int(chunk))
+    return tuple(result)
+
+
+def plan_tiles(shape, chunks, halo=DEF_HALO):
+    """ Returns a list of Tile objects that cover an array of the given shape.
+
+        :param shape: (n_rows, n_cols) shape of the complete array
+        :param chunks: (n_rows, n_cols) shape of a tile, tiles at the end can be smaller
+        :param halo: number of extra pixels that are read on each side of a tile
+    """
+    assert len(shape) == 2, "shape must be 2 dimensional"
+    assert len(chunks) == 2, "chunks must be 2 dimensional"
+    assert halo >= 0, "halo must be >= 0, got: {}".format(halo)
+
+    n_rows, n_cols = shape
+    chunk_rows, chunk_cols = chunks
+    tiles = []
+    for row in range(0, n_rows, chunk_rows):
+        row_end = min(row + chunk_rows, n_rows)
+        outer_row, outer_row_end = max(row - halo, 0), min(row_end + halo, n_rows)
+
+        for col in range(0, n_cols, chunk_cols):
+            col_end = min(col + chunk_cols, n_cols)
+            outer_col, outer_col_end = max(col - halo, 0), min(col_end + halo, n_cols)
+
+            core = (slice(row, row_end), slice(col, col_end))
+            outer = (slice(outer_row, outer_row_end), slice(outer_col, outer_col_end))
+            crop = (slice(row - outer_row, row_end - outer_row),
+                    slice(col - outer_col, col_end - outer_col))
+            tiles.append(Tile(core, outer, crop))
+    return tiles
+
+
+def run_tasks(function, items, num_workers=None):
+    """ Calls function on each item and returns the results in the same order.
+
+        Uses a local pool of threads, numpy releases the GIL during most of the calculations.
+        If num_workers is 1 the items are processed in the calling thread. If num_workers is None
+        the number of CPUs is used.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    if num_workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(function, items))
+
+
+class ChunkedArray(object):
+    """ Wraps an array-like object so that hill_shade processes it in tiles of the chunk size.
+
+        The wrapped array can be anything that has a shape attribute and supports slicing, for
+        instance a numpy memory map of an NPY file (see from_npy) or an h5py data set.
+    """
+    def __init__(self, array, chunks=DEF_CHUNKS):
+        assert len(array.shape) == 2, "array must be 2 dimensional"
+        assert len(chunks) == 2, "chunks must be 2 dimensional"
+        self.array = array
+        self.chunks = tuple(int(chunk) for chunk in chunks)
+
+    @classmethod
+    def from_npy(cls, file_name, chunks=DEF_CHUNKS):
+        """ Opens an NPY file as memory map so that only the tiles that are needed are read.
+        """
+        return cls(np.load(file_name, mmap_mode='r'), chunks=chunks)
+
+    @property
+    def shape(self):
+        return tuple(self.array.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.array, dtype=dtype)
+
+    def __repr__(self):
+        return "<ChunkedArray shape={}, chunks={}>".format(self.shape, self.chunks)
+
+
+class LazyHillShade(object):
+    """ The result of hill shading a chunked array. Is calculated tile by tile when materialized.
+
+        The shade_function is called for each tile as:
+            shade_function(data_tile, terrain_tile, norm=norm, **shade_kwargs)
+        and should return an array with the tile's rows and columns as its first two dimensions.
+
+        If the norm is not scaled, it is auto-scaled with the minimum and maximum of the complete
+        data array before the first tile is shaded. Tiles are therefore colored consistently.
+        If the norm is None, the data is not colored (e.g. when the shade_function only
+        calculates intensities), and the data is not read for the auto-scaling.
+    """
+    def __init__(self, shade_function, data, terrain=None, norm=None,
+                 chunks=None, halo=DEF_HALO, **shade_kwargs):
+        if terrain is None:
+            terrain = data
+
+        assert len(data.shape) == 2, "data must be 2 dimensional"
+        assert tuple(terrain.shape) == tuple(data.shape), \
+            "{} != {}".format(terrain.shape, data.shape)
+
+        if chunks is None:
+            chunks = chunk_shape(data if is_chunked(data) else terrain)
+
+        self.shade_function = shade_function
+        self.data = data
+        self.terrain = terrain
+        self.norm = norm
+        self.chunks = tuple(chunks)
+        self.halo = halo
+        self.shade_kwargs = shade_kwargs
+        self._probe_result = None
+
+    def __repr__(self):
+        return "<LazyHillShade shape={}, chunks={}, halo={}>".format(
+            self.shape, self.chunks, self.halo)
+
+    def _probe(self):
+        """ Shades a small corner to find the shape of the trailing dimensions and the dtype.
+            Uses a copy of the norm so that an un-scaled norm is not auto-scaled with the corner.
+        """
+        if self._probe_result is None:
+            outer = (slice(0, 2), slice(0, 2))
+            probe = self.shade_function(np.asarray(self.data[outer]),
+                                        np.asarray(self.terrain[outer]),
+                                        norm=copy.copy(self.norm), **self.shade_kwargs)
+            self._probe_result = (probe.shape[2:], probe.dtype)
+        return self._probe_result
+
+    @property
+    def shape(self):
+        trailing_shape, _ = self._probe()
+        return tuple(self.data.shape) + trailing_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        _, dtype = self._probe()
+        return dtype
+
+    def plan(self):
+        """ Returns the list of tiles that will be shaded.
+        """
+        return plan_tiles(tuple(self.data.shape), self.chunks, halo=self.halo)
+
+    def autoscale(self, num_workers=None):
+        """ Scales the norm with the minimum and maximum of the data, if it was not yet scaled.
+            Only the data is read for this, no shading is calculated.
+        """
+        if self.norm is None or self.norm.scaled():
+            return
+
+        def min_max(tile):
+            data_tile = np.asarray(self.data[tile.core])
+            return np.min(data_tile), np.max(data_tile)
+
+        min_maxes = run_tasks(min_max, self.plan(), num_workers=num_workers)
+        self.norm.autoscale_None(np.array(min_maxes))
+
+    def shade_tile(self, tile):
+        """ Reads the outer part of the tile, shades it, and returns the core of the result.
+        """
+        data_tile = np.asarray(self.data[tile.outer])
+        terrain_tile = np.asarray(self.terrain[tile.outer])
+        result = self.shade_function(data_tile, terrain_tile, norm=self.norm, **self.shade_kwargs)
+        return result[tile.crop]
+
+    def compute(self, out=None, num_workers=None):
+        """ Calculates the complete result.
+
+            :param out: array in which the result is stored. Can be a memory map.
+                If None, a new array is allocated.
+            :param num_workers: number of threads that shade tiles concurrently.
+                The default (None) is to use one thread per CPU.
+            :returns: the out array.
+        """
+        self.autoscale(num_workers=num_workers)
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        assert tuple(out.shape) == self.shape, "{} != {}".format(out.shape, self.shape)
+
+        def shade_into_out(tile):
+            out[tile.core] = self.shade_tile(tile)
+
+        run_tasks(shade_into_out, self.plan(), num_workers=num_workers)
+        return out
+
+    def to_npy(self, file_name, num_workers=None):
+        """ Calculates the result and writes it to an NPY file, without keeping it all in memory.
+            Returns the result as a memory map of the file.
+        """
+        out = np.lib.format.open_memmap(file_name, mode='w+', dtype=self.dtype, shape=self.shape)
+        self.compute(out=out, num_workers=num_workers)
+        out.flush()
+        return out
+
+    def iter_tiles(self):
+        """ Shades the tiles one by one. Yields (core, result) tuples, where core contains the
+            slices of the tile in the complete result.
+        """
+        self.autoscale()
+        for tile in self.plan():
+            yield tile.core, self.shade_tile(tile)
+
+    def __array__(self, dtype=None):
+        result = self.compute()
+        return result if dtype is None else result.astype(dtype)
+
+
+class StreamingStatistics(object):
+    """ Minimum, maximum and approximate percentiles of values that are added block by block.
+
+        The minimum, maximum and count are exact. The percentiles are calculated from a uniform
+        random sample of at most sample_size values, so the memory use does not depend on the
+        number of values. Each value gets a random key, and the values with the smallest keys are
+        kept. Statistics of separate blocks can therefore be merged in any order with the same
+        result. Non-finite values are ignored.
+    """
+    def __init__(self, sample_size=DEF_SAMPLE_SIZE, seed=0):
+        assert sample_size > 0, "sample_size must be > 0, got: {}".format(sample_size)
+        self.sample_size = sample_size
+        self.count = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self._random_state = np.random.RandomState(seed)
+        self._keys = np.empty(0)
+        self._sample = np.empty(0)
+
+    def __repr__(self):
+        return "<StreamingStatistics count={}, minimum={}, maximum={}>".format(
+            self.count, self.minimum, self.maximum)
+
+    def _keep_smallest_keys(self, keys, sample):
+        """ Keeps the sample values with the sample_size smallest keys.
+        """
+        if len(keys) > self.sample_size:
+            smallest = np.argpartition(keys, self.sample_size)[:self.sample_size]
+            keys, sample = keys[smallest], sample[smallest]
+        self._keys, self._sample = keys, sample
+
+    def update(self, values):
+        """ Adds the values (an array of any shape) to the statistics.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+
+        self.count += values.size
+        self.minimum = min(self.minimum, np.min(values))
+        self.maximum = max(self.maximum, np.max(values))
+
+        keys = self._random_state.random_sample(values.size)
+        self._keep_smallest_keys(np.concatenate([self._keys, keys]),
+                                 np.concatenate([self._sample, values]))
+
+    def merge(self, other):
+        """ Adds the statistics of another StreamingStatistics object to this one.
+        """
+        assert other.sample_size == self.sample_size, \
+            "{} != {}".format(other.sample_size, self.sample_size)
+        self.count += other.count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._keep_smallest_keys(np.concatenate([self._keys, other._keys]),
+                                 np.concatenate([self._sample, other._sample]))
+
+    def percentile(self, q):
+        """ Returns the (approximate) q-th percentile(s). The 0th and 100th are exact.
+        """
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        result = np.clip(np.percentile(self._sample, q), self.minimum, self.maximum)
+        result = np.where(np.equal(q, 0), self.minimum, result)
+        result = np.where(np.equal(q, 100), self.maximum, result)
+        return result if np.ndim(q) else float(result)
+
+    def limits(self, lower=0, upper=100):
+        """ Returns the (lower, upper) percentiles as (vmin, vmax) tuple. By default the minimum
+            and maximum. Use e.g. lower=2, upper=98 to make the limits insensitive to outliers.
+        """
+        return self.percentile(lower), self.percentile(upper)
+
+
+TileStatistics = namedtuple('TileStatistics', ['data', 'intensity'])
+TileStatistics.__doc__ = """ StreamingStatistics of the data and of the intensities.
+"""
+
+
+def tile_statistics(data, terrain=None, chunks=None, halo=DEF_HALO,
+                    sample_size=DEF_SAMPLE_SIZE, num_workers=None, **intensity_kwargs):
+    """ Calculates the statistics of the data and the intensities of the terrain, tile by tile.
+
+        Only one tile per worker is in memory at the same time and the statistics have a fixed
+        size, so this works for chunked arrays that don't fit in memory. Use the results to give
+        all tiles the same normalization, which prevents brightness jumps between tiles. E.g.:
+
+            stats = tile_statistics(data, azimuth=azimuth)
+            vmin, vmax = stats.data.limits(2, 98)
+            intensity_range = stats.intensity.limits(1, 99)
+            result = hill_shade(data, azimuth=azimuth, vmin=vmin, vmax=vmax,
+                                intensity_range=intensity_range)
+
+        The intensity_kwargs are passed to intensity.weighted_intensity. Use the same lamps and
+        gradient operator as for the shading. The result is the same for any number of workers.
+
+        :returns: TileStatistics with a StreamingStatistics of the data and of the intensities.
+    """
+    if terrain is None:
+        terrain = data
+
+    assert len(data.shape) == 2, "data must be 2 dimensional"
+    assert tuple(terrain.shape) == tuple(data.shape), \
+        "{} != {}".format(terrain.shape, data.shape)
+    assert 'intensity_range' not in intensity_kwargs, \
+        "the intensities are calculated without intensity_range"
+
+    if chunks is None:
+        chunks = chunk_shape(data if is_chunked(data) else terrain)
+
+    statistics = TileStatistics(StreamingStatistics(sample_size), StreamingStatistics(sample_size))
+    lock = threading.Lock()
+
+    def add_tile(indexed_tile):
+        index, tile = indexed_tile
+        # Seed with the tile index so that the result does not depend on the order of the tiles.
+        data_statistics = StreamingStatistics(sample_size, seed=2 * index)
+        data_statistics.update(np.asarray(data[tile.core]))
+
+        intensity = weighted_intensity(np.asarray(terrain[tile.outer]), **intensity_kwargs)
+        intensity_statistics = StreamingStatistics(sample_size, seed=2 * index + 1)
+        intensity_statistics.update(intensity[tile.crop])
+
+        with lock:
+            statistics.data.merge(data_statistics)
+            statistics.intensity.merge(intensity_statistics)
+
+    tiles = plan_tiles(tuple(data.shape), chunks, halo=halo)
+    run_tasks(add_tile, list(enumerate(tiles)), num_workers=num_workers)
+    return statistics